@@ -1,20 +1,27 @@
 import os
-import base64
+import pybase64
 import json
 import re
-import time
+import orjson
+import asyncio
+import argparse
 import datetime
-from collections import Counter
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from statistics import mode
+import numpy as np
 import pandas as pd
 from PIL import Image
 from pathlib import Path
-from PyPDF2 import PdfReader
+import pikepdf
 from io import BytesIO
 
 # Choose ONE of these import blocks based on your preferred access method:
 
 # Option 1: Using Anthropic's direct API
 import anthropic
+import httpx
 
 # Option 2: Using AWS Bedrock
 import boto3
@@ -24,19 +31,30 @@ from botocore.config import Config
 USE_ANTHROPIC_DIRECT = True
 USE_AWS_BEDROCK = False
 
+# Concurrency settings for process_folder
+MAX_CONCURRENT_REQUESTS = 8  # Files in flight at once
+REQUESTS_PER_SECOND = 0.8  # Match your API tier (Anthropic tier 1 allows 50 requests/minute)
+
 # Configure clients based on choice
 if USE_ANTHROPIC_DIRECT:
-    # Initialize Anthropic client
-    anthropic_client = anthropic.Anthropic(api_key="YOUR-API-KEY-HERE")
+    # Initialize one shared Anthropic client (async, so many invoices can be in flight at once).
+    # The pooled HTTP/2 keep-alive connections avoid a fresh TLS handshake on every request.
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+        http2=True
+    )
+    anthropic_client = anthropic.AsyncAnthropic(api_key="YOUR-API-KEY-HERE", http_client=http_client)
     MODEL_ID = "claude-3-7-sonnet-20250219"
 elif USE_AWS_BEDROCK:
     # Initialize AWS Bedrock client
     bedrock_config = Config(
         region_name="us-east-1",  # Change to your preferred region
         signature_version="v4",
+        max_pool_connections=50,  # Enough connections for MAX_CONCURRENT_REQUESTS
+        tcp_keepalive=True,
         retries={
-            'max_attempts': 3,
-            'mode': 'standard'
+            'max_attempts': 2,  # call_claude_with_retries handles further retries
+            'mode': 'adaptive'
         }
     )
     bedrock_runtime = boto3.client('bedrock-runtime', config=bedrock_config)
@@ -44,34 +62,184 @@ elif USE_AWS_BEDROCK:
 else:
     raise ValueError("You must enable either Anthropic API or AWS Bedrock")
 
+# Columns that should be padded with 0 rather than ''
+NUMERIC_KEYS = frozenset({'Qty', 'U.Price', 'Total'})
+
+# Image formats Claude accepts directly (keyed by Pillow format name)
+IMAGE_MEDIA_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif'
+}
+# Claude 3.7 Sonnet accepts at most this many pages per PDF; longer PDFs are split
+MAX_PDF_PAGES = 100
+
+# File extensions process_folder picks up
+PDF_EXTS = frozenset({'.pdf'})
+IMG_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.webp', '.heic', '.gif'})
+SUPPORTED_EXTS = PDF_EXTS | IMG_EXTS
+
+# Claude downscales anything larger than this on its long edge
+MAX_IMAGE_DIMENSION = 1568
+
+# Matches a comma directly before a closing brace/bracket, compiled once for every response
+TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
+class RateLimiter:
+    """Space out API calls so no more than `rate` requests start per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        """Sleep until the next request slot is available, then claim it."""
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            await asyncio.sleep(max(0, self.next_slot - now))
+            self.next_slot = max(now, self.next_slot) + self.interval
+
+def file_sha256(file_path, prefix=b''):
+    """Return the SHA-256 hex digest of prefix followed by a file's contents."""
+    sha = hashlib.sha256(prefix)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def disk_cache(fetch_func):
+    """Cache the invoice JSON returned by a per-file coroutine, keyed by model, prompt and file content.
+    
+    Only Claude's answer is cached, so changes to cleaning or markup still apply on a cache hit,
+    and editing the prompt or model invalidates old entries. Pass cache_dir=None (the default)
+    to disable caching for a call.
+    """
+    @functools.wraps(fetch_func)
+    async def wrapper(file_path, *args, cache_dir=None, **kwargs):
+        if cache_dir is None:
+            return await fetch_func(file_path, *args, **kwargs)
+        
+        # Hashing and cache file I/O touch the disk, so keep them off the event loop
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, file_sha256, file_path, CACHE_KEY_PREFIX)
+        cache_path = os.path.join(cache_dir, f"{digest}.json")
+        if os.path.exists(cache_path):
+            print(f"Using cached result for {file_path}")
+            return orjson.loads(await loop.run_in_executor(None, Path(cache_path).read_bytes))
+        
+        json_data = await fetch_func(file_path, *args, **kwargs)
+        
+        # Only cache successful extractions so failed files are retried on the next run
+        if json_data:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                # Write to a temporary file first so an interrupted run never leaves a partial cache entry
+                tmp_path = f"{cache_path}.tmp"
+                await loop.run_in_executor(None, Path(tmp_path).write_bytes, orjson.dumps(json_data))
+                os.replace(tmp_path, cache_path)
+            except Exception as e:
+                print(f"Could not cache result for {file_path}: {e}")
+        return json_data
+    
+    return wrapper
+
+def b64encode_file(file_path, chunk_size=57 * 1024):
+    """Base64-encode a file in chunks so the raw bytes are never held in memory all at once.
+    
+    chunk_size must be a multiple of 3 so no padding appears mid-stream.
+    """
+    encoded = bytearray()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            encoded += pybase64.b64encode(chunk)
+    return encoded.decode('ascii')
+
 def validate_pdf(pdf_path):
-    """Validate PDF using PyPDF2."""
+    """Validate PDF using pikepdf (qpdf), which counts pages without parsing every page object.
+    
+    Returns the page count, or 0 if the PDF can't be read.
+    """
     try:
-        reader = PdfReader(pdf_path)
-        page_count = len(reader.pages)
+        with pikepdf.open(pdf_path) as pdf:
+            page_count = len(pdf.pages)
         print(f"PDF {pdf_path} has {page_count} pages")
-        # Claude 3.7 Sonnet has a limit of 100 pages per PDF
-        if page_count > 100:
-            print(f"Warning: PDF has {page_count} pages, exceeding Claude's 100-page limit")
-        return True
+        if page_count > MAX_PDF_PAGES:
+            print(f"PDF has {page_count} pages, exceeding Claude's {MAX_PDF_PAGES}-page limit; "
+                  f"it will be sent in {MAX_PDF_PAGES}-page shards")
+        return page_count
     except Exception as e:
         print(f"Invalid PDF {pdf_path}: {e}")
-        return False
+        return 0
 
-def extract_json_from_response(response_text):
-    """Extract valid JSON from the response text."""
-    json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-    if not json_match:
-        return None
+def shard_pdf(pdf_path, shard_size=MAX_PDF_PAGES):
+    """Yield the PDF as consecutive shards of at most shard_size pages, each as bytes."""
+    with pikepdf.open(pdf_path) as src:
+        for start in range(0, len(src.pages), shard_size):
+            shard = pikepdf.Pdf.new()
+            shard.pages.extend(src.pages[start:start + shard_size])
+            buffered = BytesIO()
+            shard.save(buffered)
+            yield buffered.getvalue()
+
+class JsonObjectScanner:
+    """Find balanced top-level {...} objects in text fed in one or more chunks.
     
+    Scanning is a single linear pass, so objects can be picked out of a streamed
+    response as soon as their closing brace arrives.
+    """
+
+    def __init__(self):
+        self.parts = []  # Text of the object currently being scanned
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, chunk):
+        """Scan the next chunk of text, yielding each top-level object it completes."""
+        start = 0 if self.depth > 0 else None
+        for i, char in enumerate(chunk):
+            if self.in_string:
+                # Braces inside JSON strings (e.g. product names) don't count
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = self.depth > 0
+            elif char == '{':
+                if self.depth == 0:
+                    start = i
+                self.depth += 1
+            elif char == '}' and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(chunk[start:i + 1])
+                    json_span = ''.join(self.parts)
+                    self.parts = []
+                    start = None
+                    yield json_span
+        if self.depth > 0:
+            self.parts.append(chunk[start:])
+
+def parse_invoice_json(json_span):
+    """Parse one {...} object, returning it only if it contains product data."""
     try:
-        json_data = json.loads(json_match.group())
-        # Verify we have at least product data
-        if 'Product' not in json_data or not json_data['Product']:
+        json_data = orjson.loads(json_span)
+    except orjson.JSONDecodeError:
+        # Models sometimes emit trailing commas; strip them and try once more
+        try:
+            json_data = orjson.loads(TRAILING_COMMA_RE.sub(r'\1', json_span))
+        except orjson.JSONDecodeError:
             return None
-        return json_data
-    except json.JSONDecodeError:
+    
+    # Verify we have at least product data
+    if 'Product' not in json_data or not json_data['Product']:
         return None
+    return json_data
 
 def ensure_equal_length_arrays(json_data):
     """Ensure all arrays in the JSON have equal length, with smarter padding."""
@@ -84,49 +252,79 @@ def ensure_equal_length_arrays(json_data):
     if not non_empty_lengths:
         return json_data
     
-    # Use the most common non-zero length
-    length_counts = Counter(non_empty_lengths)
-    target_length = length_counts.most_common(1)[0][0]
+    # Use the most common non-zero length (ties go to the first seen, as before)
+    target_length = mode(non_empty_lengths)
     
-    # Adjust arrays to the target length
+    # Adjust arrays to the target length: truncate longer ones, pad shorter (or empty) ones
     for key in array_keys:
-        current_length = len(json_data[key])
-        if current_length == 0:
-            # For empty arrays, create appropriate placeholders
-            filler = 0 if key in ['Qty', 'U.Price', 'Total'] else ''
-            json_data[key] = [filler] * target_length
-        elif current_length < target_length:
-            # For shorter arrays, add padding
-            filler = 0 if key in ['Qty', 'U.Price', 'Total'] else ''
-            json_data[key].extend([filler] * (target_length - current_length))
-        elif current_length > target_length:
-            # For longer arrays, truncate to avoid excessive padding
-            json_data[key] = json_data[key][:target_length]
+        values = json_data[key]
+        if len(values) > target_length:
+            json_data[key] = values[:target_length]
+        else:
+            filler = 0 if key in NUMERIC_KEYS else ''
+            json_data[key] = values + [filler] * (target_length - len(values))
     
     return json_data
 
-def clean_dataframe(df):
-    """Remove empty or mostly zero rows from the extracted data."""
-    # Create a mask for rows to keep
-    # Keep rows where Product has a value or Total is greater than 0
-    mask = (df['Product'].str.strip() != '') & (df['Product'].notna())
-    mask = mask | ((df['Total'] > 0) & df['Total'].notna())
+def merge_invoice_json(parts):
+    """Concatenate the arrays of several extraction results (e.g. one per PDF shard), skipping empty ones."""
+    parts = [ensure_equal_length_arrays(part) for part in parts if part]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
     
-    # Apply the mask to keep only valid rows
-    cleaned_df = df[mask].copy()
+    array_keys = dict.fromkeys(key for part in parts for key, value in part.items() if isinstance(value, list))
+    merged = {key: [] for key in array_keys}
+    for part in parts:
+        row_count = len(part['Product'])
+        for key in array_keys:
+            values = part.get(key)
+            if not isinstance(values, list):
+                # Pad keys this part didn't return so every array stays the same length
+                values = [0 if key in NUMERIC_KEYS else ''] * row_count
+            merged[key].extend(values)
+    return merged
+
+def invoke_bedrock(request_body):
+    """Stream a response from Claude on AWS Bedrock and return its invoice JSON (blocking)."""
+    response = bedrock_runtime.invoke_model_with_response_stream(
+        modelId=MODEL_ID,
+        body=json.dumps(request_body)
+    )
     
-    # Reset the index
-    cleaned_df.reset_index(drop=True, inplace=True)
+    stream = response['body']
+    scanner = JsonObjectScanner()
+    try:
+        for event in stream:
+            if 'chunk' not in event:
+                continue
+            chunk = json.loads(event['chunk']['bytes'])
+            if chunk.get('type') != 'content_block_delta' or chunk['delta'].get('type') != 'text_delta':
+                continue
+            for json_span in scanner.feed(chunk['delta']['text']):
+                json_data = parse_invoice_json(json_span)
+                if json_data:
+                    return json_data
+    finally:
+        # Stop receiving the rest of the response once we have what we need
+        stream.close()
     
-    return cleaned_df
+    return None
 
-def call_claude_with_retries(prompt_text, content, is_pdf=False, retries=3, delay=5):
-    """Call Claude 3.7 Sonnet API with retry logic."""
+async def call_claude_with_retries(prompt_text, content, limiter, is_pdf=False, retries=3, delay=5):
+    """Call Claude 3.7 Sonnet API with retry logic, waiting on the rate limiter before each attempt.
+    
+    The response is streamed and parsed as it arrives; the extracted invoice JSON is returned
+    as soon as its closing brace is received, or None if the response contains no valid JSON.
+    """
     for attempt in range(retries):
         try:
+            await limiter.wait()
+            
             if USE_ANTHROPIC_DIRECT:
                 # Using Anthropic API directly
-                message = anthropic_client.messages.create(
+                async with anthropic_client.messages.stream(
                     model=MODEL_ID,
                     max_tokens=8192,
                     # Use system prompt to disable thinking block for now
@@ -136,24 +334,22 @@ def call_claude_with_retries(prompt_text, content, is_pdf=False, retries=3, dela
                         {
                             "role": "user",
                             "content": [
-                                {"type": "text", "text": prompt_text},
+                                # Mark the shared prompt as cacheable so repeat requests reuse it server-side
+                                {"type": "text", "text": prompt_text, "cache_control": {"type": "ephemeral"}},
                                 content
                             ]
                         }
                     ]
-                )
+                ) as stream:
+                    scanner = JsonObjectScanner()
+                    async for text in stream.text_stream:
+                        for json_span in scanner.feed(text):
+                            json_data = parse_invoice_json(json_span)
+                            if json_data:
+                                # Leaving the block closes the stream and skips the rest of the response
+                                return json_data
                 
-                # For regular responses without thinking blocks
-                if hasattr(message.content[0], 'text'):
-                    return message.content[0].text
-                else:
-                    # Try to find any text content
-                    for block in message.content:
-                        if hasattr(block, 'text'):
-                            return block.text
-                    
-                    # If no text content is found
-                    raise ValueError("No text content found in Claude's response")
+                return None
             
             elif USE_AWS_BEDROCK:
                 # Using AWS Bedrock
@@ -165,32 +361,25 @@ def call_claude_with_retries(prompt_text, content, is_pdf=False, retries=3, dela
                         {
                             "role": "user",
                             "content": [
-                                {"type": "text", "text": prompt_text},
+                                {"type": "text", "text": prompt_text, "cache_control": {"type": "ephemeral"}},
                                 content
                             ]
                         }
                     ]
                 }
                 
-                response = bedrock_runtime.invoke_model(
-                    modelId=MODEL_ID,
-                    body=json.dumps(request_body)
-                )
-                
-                response_body = json.loads(response['body'].read().decode('utf-8'))
-                
-                # Extract text content from the response
-                if 'content' in response_body and len(response_body['content']) > 0:
-                    for content_block in response_body['content']:
-                        if 'type' in content_block and content_block['type'] == 'text':
-                            return content_block['text']
-                
-                raise ValueError("No text content found in Claude's response")
+                # boto3 is blocking, so run it on a worker thread to keep the event loop free
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(None, invoke_bedrock, request_body)
             
+        except anthropic.RateLimitError as e:
+            print(f"Attempt {attempt+1} was rate limited: {e}")
+            if attempt < retries - 1:
+                await asyncio.sleep(delay * 2 ** (attempt + 1))  # Double the wait on each rate limit
         except Exception as e:
             print(f"Attempt {attempt+1} failed: {e}")
             if attempt < retries - 1:  # Don't sleep after the last attempt
-                time.sleep(delay * (attempt + 1))  # Exponential backoff
+                await asyncio.sleep(delay * (attempt + 1))  # Exponential backoff
     
     raise Exception("All retries failed")
 
@@ -245,92 +434,88 @@ def get_extraction_prompt():
     }
     """
 
-def process_pdf(pdf_path):
-    """Process PDF file with Claude 3.7 Sonnet."""
+# The prompt is identical for every invoice, so build it once
+EXTRACTION_PROMPT = get_extraction_prompt()
+
+# Mixed into every cache key so a new model or prompt never reuses old answers
+CACHE_KEY_PREFIX = hashlib.sha256(f"{MODEL_ID}\n{EXTRACTION_PROMPT}".encode()).digest()
+
+def make_pdf_content(pdf_data):
+    """Wrap base64 PDF data as a Claude content block."""
+    # For Claude 3.7 Sonnet (direct API and AWS Bedrock), PDFs must be sent as "document" type, not "image" type
+    return {
+        "type": "document",  # IMPORTANT: Use "document" not "image" for PDFs
+        "source": {
+            "type": "base64", 
+            "media_type": "application/pdf",
+            "data": pdf_data
+        }
+    }
+
+def encode_pdf_shards(pdf_path, page_count):
+    """Return the PDF as a list of base64 strings: the whole file, or one per shard if it's over the page limit."""
+    if page_count <= MAX_PDF_PAGES:
+        return [b64encode_file(pdf_path)]
+    return [pybase64.b64encode(shard).decode('ascii') for shard in shard_pdf(pdf_path)]
+
+def encode_image(image_path):
+    """Return (media_type, base64 data) for an image, downscaling or converting it only when needed."""
+    # Image.open only reads the header, so checking format and size here is cheap
+    with Image.open(image_path) as img:
+        media_type = IMAGE_MEDIA_TYPES.get(img.format)
+        if media_type and max(img.size) <= MAX_IMAGE_DIMENSION:
+            # Supported format at a usable size: send the file bytes as-is, no re-encode
+            return media_type, b64encode_file(image_path)
+        
+        # Downscale oversized images (Claude resizes them anyway) and convert
+        # other formats to PNG, keeping JPEGs as JPEG to avoid inflating them
+        img.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.LANCZOS)
+        buffered = BytesIO()
+        if media_type == 'image/jpeg':
+            img.save(buffered, format='JPEG', quality=90)
+        else:
+            if img.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+                img = img.convert('RGB')
+            img.save(buffered, format='PNG')
+            media_type = 'image/png'
+        return media_type, pybase64.b64encode(buffered.getvalue()).decode('ascii')
+
+async def fetch_pdf_json(pdf_path, limiter):
+    """Send PDF file to Claude 3.7 Sonnet and return the extracted invoice JSON, or None.
+    
+    PDFs over Claude's page limit are split into shards that are sent concurrently and
+    whose results are merged.
+    """
     try:
-        if not validate_pdf(pdf_path):
-            return pd.DataFrame()
-            
-        # For Claude 3.7 Sonnet, PDFs must be sent as "document" type, not "image" type
-        if USE_ANTHROPIC_DIRECT:
-            with open(pdf_path, 'rb') as f:
-                pdf_content = {
-                    "type": "document",  # IMPORTANT: Use "document" not "image" for PDFs
-                    "source": {
-                        "type": "base64", 
-                        "media_type": "application/pdf",
-                        "data": base64.b64encode(f.read()).decode('utf-8')
-                    }
-                }
-        elif USE_AWS_BEDROCK:
-            # AWS Bedrock also requires "document" type for PDFs
-            with open(pdf_path, 'rb') as f:
-                pdf_content = {
-                    "type": "document",  # IMPORTANT: Use "document" not "image" for PDFs
-                    "source": {
-                        "type": "base64", 
-                        "media_type": "application/pdf",
-                        "data": base64.b64encode(f.read()).decode('utf-8')
-                    }
-                }
+        # pikepdf and base64 work is CPU- and disk-bound, so run it on a worker thread
+        # instead of stalling every other response streaming on the event loop
+        loop = asyncio.get_running_loop()
+        page_count = await loop.run_in_executor(None, validate_pdf, pdf_path)
+        if not page_count:
+            return None
         
-        # Call Claude with the PDF
-        prompt = get_extraction_prompt()
-        response = call_claude_with_retries(prompt, pdf_content, is_pdf=True)
+        shards = await loop.run_in_executor(None, encode_pdf_shards, pdf_path, page_count)
         
-        # Extract and process JSON
-        json_data = extract_json_from_response(response)
+        # Call Claude with the PDF (or each of its shards)
+        results = await asyncio.gather(*[
+            call_claude_with_retries(EXTRACTION_PROMPT, make_pdf_content(data), limiter, is_pdf=True)
+            for data in shards
+        ])
+        json_data = merge_invoice_json(results)
         if not json_data:
             print(f"No valid JSON found in response for {pdf_path}")
-            return pd.DataFrame()
-        
-        # Normalize and create DataFrame
-        json_data = ensure_equal_length_arrays(json_data)
-        df = pd.DataFrame(json_data)
-        
-        # Convert numeric columns
-        for col in ['Qty', 'U.Price', 'Total']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        # Calculate markup on unit price (not total)
-        if 'U.Price' in df.columns:
-            df['Marked_Up_Price'] = df['U.Price'] * 1.25
-        
-        # Add source information and clean the data
-        df['Source'] = os.path.basename(pdf_path)
-        df = clean_dataframe(df)
-        
-        return df
+        return json_data
     
     except Exception as e:
         print(f"Error processing {pdf_path}: {e}")
-        return pd.DataFrame()
+        return None
 
-def process_image(image_path):
-    """Process image file with Claude 3.7 Sonnet."""
+async def fetch_image_json(image_path, limiter):
+    """Send image file to Claude 3.7 Sonnet and return the extracted invoice JSON, or None."""
     try:
-        # Open the image and convert to base64
-        with Image.open(image_path) as img:
-            buffered = BytesIO()
-            img.save(buffered, format=img.format if img.format else 'JPEG')
-            img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-            
-            # Determine media type based on image format
-            if img.format and img.format.lower() in ['jpeg', 'jpg']:
-                media_type = 'image/jpeg'
-            elif img.format and img.format.lower() == 'png':
-                media_type = 'image/png'
-            elif img.format and img.format.lower() == 'webp':
-                media_type = 'image/webp'
-            elif img.format and img.format.lower() == 'gif':
-                media_type = 'image/gif'
-            else:
-                # Convert to PNG for other formats
-                buffered = BytesIO()
-                img.save(buffered, format='PNG')
-                img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                media_type = 'image/png'
+        # Decoding, resizing and encoding are CPU-bound, so run them on a worker thread
+        loop = asyncio.get_running_loop()
+        media_type, img_str = await loop.run_in_executor(None, encode_image, image_path)
         
         # Prepare image content for Claude - use "image" type for images
         if USE_ANTHROPIC_DIRECT:
@@ -353,96 +538,221 @@ def process_image(image_path):
             }
         
         # Call Claude with the image
-        prompt = get_extraction_prompt()
-        response = call_claude_with_retries(prompt, image_content, is_pdf=False)
-        
-        # Extract and process JSON
-        json_data = extract_json_from_response(response)
+        json_data = await call_claude_with_retries(EXTRACTION_PROMPT, image_content, limiter, is_pdf=False)
         if not json_data:
             print(f"No valid JSON found in response for {image_path}")
-            return pd.DataFrame()
-        
-        # Normalize and create DataFrame
-        json_data = ensure_equal_length_arrays(json_data)
-        df = pd.DataFrame(json_data)
-        
-        # Convert numeric columns
-        for col in ['Qty', 'U.Price', 'Total']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        # Calculate markup on unit price (not total)
-        if 'U.Price' in df.columns:
-            df['Marked_Up_Price'] = df['U.Price'] * 1.25
-        
-        # Add source information and clean the data
-        df['Source'] = os.path.basename(image_path)
-        df = clean_dataframe(df)
-        
-        return df
+        return json_data
     
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
+        return None
+
+def invoice_sort_key(column):
+    """Sort key for the combined data: real dates for Date, categorical codes for Product.
+    
+    Both compare as integers instead of Python strings; the column values themselves are left unchanged.
+    """
+    if column.name == 'Date':
+        return pd.to_datetime(column, format='%Y-%m-%d', errors='coerce')
+    return column.astype('category')
+
+def write_excel(df, output_path):
+    """Write a DataFrame to Excel with the xlsxwriter engine.
+    
+    constant_memory is deliberately not used: pandas writes cells column by column,
+    and that mode silently drops any cell written to a row it has already flushed.
+    """
+    with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False)
+
+def to_float_array(values):
+    """Convert a list of JSON values to a float array, coercing unparseable entries to NaN."""
+    try:
+        # Fast path: JSON numbers (and None) cast directly in C
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float64)
+
+def build_dataframe(json_data, source):
+    """Build the cleaned, marked-up DataFrame for one invoice's JSON in a single pass."""
+    json_data = ensure_equal_length_arrays(json_data)
+    
+    # Convert numeric columns straight to float arrays so pandas needn't infer their types
+    numeric = {
+        key: to_float_array(values)
+        for key, values in json_data.items() if key in NUMERIC_KEYS and isinstance(values, list)
+    }
+    
+    # Keep rows where Product has a value or Total is greater than 0
+    products = json_data['Product']
+    has_product = np.fromiter((p is not None and str(p).strip() != '' for p in products),
+                              dtype=bool, count=len(products))
+    if 'Total' in numeric:
+        keep = has_product | (numeric['Total'] > 0)
+    else:
+        keep = has_product
+    keep_rows = np.flatnonzero(keep)
+    
+    # Build only the rows that survive cleaning
+    columns = {}
+    for key, values in json_data.items():
+        if key in numeric:
+            columns[key] = numeric[key][keep_rows]
+        elif isinstance(values, list):
+            columns[key] = [values[i] for i in keep_rows]
+        else:
+            columns[key] = values
+    
+    # Calculate markup on unit price (not total)
+    if 'U.Price' in numeric:
+        columns['Marked_Up_Price'] = columns['U.Price'] * 1.25
+    
+    # Add source information
+    columns['Source'] = source
+    
+    return pd.DataFrame(columns, copy=False)
+
+@disk_cache
+async def fetch_invoice_json(file_path, sem, limiter):
+    """Send a single invoice file to Claude and return its JSON, holding a semaphore slot while in flight."""
+    async with sem:
+        print(f"Processing file: {os.path.basename(file_path)}")
+        if Path(file_path).suffix.lower() in PDF_EXTS:
+            return await fetch_pdf_json(file_path, limiter)
+        return await fetch_image_json(file_path, limiter)
+
+async def process_file_async(file_path, sem, limiter, cache_dir=None):
+    """Process a single invoice file and return its DataFrame.
+    
+    The invoice JSON comes from Claude or the cache; building the DataFrame afterwards is a
+    few dozen rows of work, so it runs inline.
+    """
+    json_data = await fetch_invoice_json(file_path, sem, limiter, cache_dir=cache_dir)
+    if not json_data:
+        return pd.DataFrame()
+    
+    try:
+        return build_dataframe(json_data, os.path.basename(file_path))
+    except Exception as e:
+        print(f"Error processing {file_path}: {e}")
         return pd.DataFrame()
 
-def process_folder(input_folder="/content/invoices", output_folder="output"):
-    """Process all invoices in folder and save results."""
+async def process_files_async(file_paths, max_concurrency=MAX_CONCURRENT_REQUESTS,
+                              requests_per_second=REQUESTS_PER_SECOND, cache_dir=None):
+    """Process files concurrently and return their DataFrames in the same order."""
+    sem = asyncio.Semaphore(max_concurrency)
+    limiter = RateLimiter(requests_per_second)
+    return await asyncio.gather(*[
+        process_file_async(path, sem, limiter, cache_dir=cache_dir) for path in file_paths
+    ])
+
+async def process_folder_async(input_folder="/content/invoices", output_folder="output", use_cache=True,
+                               output_format="xlsx"):
+    """Process all invoices in folder and save results.
+    
+    Await this directly where an event loop is already running (Jupyter/Colab);
+    otherwise call process_folder. Claude's extracted JSON is cached under
+    <output_folder>/.cache by model, prompt and file content, so re-running on the same
+    invoices skips the API calls. Set use_cache=False to force fresh extraction.
+    
+    With output_format="xlsx", per-invoice and combined Excel files are written alongside
+    a combined Parquet file; with output_format="parquet", only the combined Parquet file is.
+    """
     os.makedirs(output_folder, exist_ok=True)
-    all_data = []
-    
-    # Get list of files to process
-    files = os.listdir(input_folder)
-    total_files = len(files)
-    print(f"Found {total_files} files in {input_folder}")
-    
-    # Process files
-    processed_count = 0
-    for file in files:
-        file_path = os.path.join(input_folder, file)
-        if os.path.isdir(file_path):
-            continue
-            
-        processed_count += 1
-        print(f"Processing file {processed_count}/{total_files}: {file}")
-            
-        if file.lower().endswith(('.pdf', '.PDF')):
-            df = process_pdf(file_path)
-        elif file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.heic', '.gif')):
-            df = process_image(file_path)
-        else:
-            print(f"Skipping unsupported file: {file}")
-            continue
-            
-        if not df.empty:
-            # Save individual file
-            output_path = os.path.join(output_folder, f"{Path(file).stem}.xlsx")
-            df.to_excel(output_path, index=False)
-            print(f"Saved data to {output_path}")
-            all_data.append(df)
+    
+    # Get list of files to process (scandir entries carry their file type, so no extra stat per file)
+    with os.scandir(input_folder) as it:
+        entries = [entry for entry in it if entry.is_file()]
+    print(f"Found {len(entries)} files in {input_folder}")
+    
+    # Collect supported files
+    file_paths = []
+    for entry in entries:
+        if Path(entry.name).suffix.lower() in SUPPORTED_EXTS:
+            file_paths.append(entry.path)
         else:
-            print(f"No data extracted from {file}")
+            print(f"Skipping unsupported file: {entry.name}")
+    
+    # Send all files to Claude concurrently; the combining and saving below only starts once every file is done
+    print(f"Processing {len(file_paths)} files with up to {MAX_CONCURRENT_REQUESTS} concurrent requests")
+    cache_dir = os.path.join(output_folder, ".cache") if use_cache else None
+    results = await process_files_async(file_paths, cache_dir=cache_dir)
     
-    # Save combined results
+    all_data = [df for df in results if not df.empty]
+    
+    # Save results
     if all_data:
-        # Combine all individual DataFrames
-        combined_df = pd.concat(all_data, ignore_index=True)
+        # Combine all individual DataFrames (already cleaned and marked up) in one pass
+        combined_df = pd.concat(all_data, ignore_index=True, copy=False)
+        
+        # Save individual files, one per source invoice, each with only the columns its invoice had
+        if output_format == "xlsx":
+            for df in all_data:
+                output_path = os.path.join(output_folder, f"{Path(df['Source'].iat[0]).stem}.xlsx")
+                write_excel(df, output_path)
+                print(f"Saved data to {output_path}")
         
-        # Apply final cleaning to remove any remaining empty/zero rows
-        combined_df = clean_dataframe(combined_df)
+        extracted_sources = set(combined_df['Source'])
+        for file_path in file_paths:
+            if os.path.basename(file_path) not in extracted_sources:
+                print(f"No data extracted from {os.path.basename(file_path)}")
         
         # Sort by Date and then by Product for better organization
         if 'Date' in combined_df.columns:
-            combined_df.sort_values(['Date', 'Product'], inplace=True)
+            combined_df.sort_values(['Date', 'Product'], key=invoice_sort_key, inplace=True)
         combined_df.reset_index(drop=True, inplace=True)
         
         # Generate timestamp and save
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        combined_path = os.path.join(output_folder, f"combined_invoices_{timestamp}.xlsx")
-        combined_df.to_excel(combined_path, index=False)
-        print(f"\nProcessed {len(all_data)} files successfully. Combined file saved to {combined_path}")
+        saved_paths = []
+        if output_format == "xlsx":
+            combined_path = os.path.join(output_folder, f"combined_invoices_{timestamp}.xlsx")
+            write_excel(combined_df, combined_path)
+            saved_paths.append(combined_path)
+        
+        # Arrow needs one type per column, so store free-text columns (which may mix
+        # strings and numbers, e.g. a numeric product name) as nullable strings
+        combined_path = os.path.join(output_folder, f"combined_invoices_{timestamp}.parquet")
+        try:
+            text_columns = [col for col in combined_df.columns if combined_df[col].dtype == object]
+            combined_df.astype({col: 'string' for col in text_columns}).to_parquet(
+                combined_path, engine='pyarrow', compression='zstd', index=False)
+            saved_paths.append(combined_path)
+        except Exception as e:
+            print(f"Could not save combined Parquet file {combined_path}: {e}")
+        
+        if saved_paths:
+            print(f"\nProcessed {len(extracted_sources)} files successfully. "
+                  f"Combined file saved to {' and '.join(saved_paths)}")
+        else:
+            print(f"\nProcessed {len(extracted_sources)} files successfully, but no combined file could be saved.")
         print(f"Combined file contains {len(combined_df)} rows of data after cleaning.")
     else:
         print("No data extracted from any files. Combined file not created.")
 
+def process_folder(input_folder="/content/invoices", output_folder="output", use_cache=True,
+                   output_format="xlsx"):
+    """Process all invoices in folder and save results (see process_folder_async)."""
+    coro = process_folder_async(input_folder, output_folder, use_cache, output_format)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # No loop running (plain script): start one here
+        asyncio.run(coro)
+        return
+    
+    # A loop is already running (Jupyter/Colab), and asyncio.run can't nest inside it,
+    # so run the pipeline on its own loop in a worker thread and wait for it
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(asyncio.run, coro).result()
+
 if __name__ == "__main__":
-    process_folder()
+    parser = argparse.ArgumentParser(description="Extract invoice data with Claude 3.7 Sonnet")
+    parser.add_argument("--input", default="/content/invoices", help="Folder of invoice PDFs and images")
+    parser.add_argument("--output", default="output", help="Folder to write results to")
+    parser.add_argument("--format", choices=["xlsx", "parquet"], default="xlsx",
+                        help="xlsx: per-invoice and combined Excel plus combined Parquet; "
+                             "parquet: combined Parquet only")
+    # parse_known_args so the script still runs when pasted into a notebook
+    args, _ = parser.parse_known_args()
+    process_folder(args.input, args.output, output_format=args.format)
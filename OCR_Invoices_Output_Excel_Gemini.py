@@ -1,114 +1,48 @@
 import os
-import base64
-import json
-import re
-import time
+import orjson
+import asyncio
 import datetime
-from collections import Counter
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from statistics import mode
+import numpy as np
 import pandas as pd
 import google.generativeai as genai
-from PIL import Image
 from pathlib import Path
+from io import BytesIO
 from PyPDF2 import PdfReader
 
 # Configure the Gemini API
 genai.configure(api_key="YOUR_GEMINI_API_KEY")
 
-def validate_pdf(pdf_path):
-    """Validate PDF using PyPDF2."""
-    try:
-        reader = PdfReader(pdf_path)
-        print(f"PDF {pdf_path} has {len(reader.pages)} pages")
-        return True
-    except Exception as e:
-        print(f"Invalid PDF {pdf_path}: {e}")
-        return False
-
-def extract_json_from_response(response_text):
-    """Extract valid JSON from the response text."""
-    json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-    if not json_match:
-        return None
-
-    try:
-        json_data = json.loads(json_match.group())
-        # Verify we have at least product data
-        if 'Product' not in json_data or not json_data['Product']:
-            return None
-        return json_data
-    except json.JSONDecodeError:
-        return None
-
-def ensure_equal_length_arrays(json_data):
-    """Ensure all arrays in the JSON have equal length, with smarter padding."""
-    array_keys = [key for key, value in json_data.items() if isinstance(value, list)]
-    if not array_keys:
-        return json_data
-
-    # Find non-empty arrays and their lengths
-    non_empty_lengths = [len(json_data[key]) for key in array_keys if len(json_data[key]) > 0]
-    if not non_empty_lengths:
-        return json_data
-
-    # Use the most common non-zero length
-    length_counts = Counter(non_empty_lengths)
-    target_length = length_counts.most_common(1)[0][0]
-
-    # Adjust arrays to the target length
-    for key in array_keys:
-        current_length = len(json_data[key])
-        if current_length == 0:
-            # For empty arrays, create appropriate placeholders
-            filler = 0 if key in ['Qty', 'U.Price', 'Total'] else ''
-            json_data[key] = [filler] * target_length
-        elif current_length < target_length:
-            # For shorter arrays, add padding
-            filler = 0 if key in ['Qty', 'U.Price', 'Total'] else ''
-            json_data[key].extend([filler] * (target_length - current_length))
-        elif current_length > target_length:
-            # For longer arrays, truncate to avoid excessive padding
-            json_data[key] = json_data[key][:target_length]
-
-    return json_data
-
-def clean_dataframe(df):
-    """Remove empty or mostly zero rows from the extracted data."""
-    # Create a mask for rows to keep
-    # Keep rows where Product has a value or Total is greater than 0
-    mask = (df['Product'].str.strip() != '') & (df['Product'].notna())
-    mask = mask | ((df['Total'] > 0) & df['Total'].notna())
-
-    # Apply the mask to keep only valid rows
-    cleaned_df = df[mask].copy()
-
-    # Reset the index
-    cleaned_df.reset_index(drop=True, inplace=True)
-
-    return cleaned_df
-
-def call_gemini_with_retries(model, payload, retries=3, delay=5):
-    """Retry API calls on failure."""
-    for attempt in range(retries):
-        try:
-            response = model.generate_content(payload)
-            return response.text
-        except Exception as e:
-            print(f"Attempt {attempt+1} failed: {e}")
-            if attempt < retries - 1:  # Don't sleep after the last attempt
-                time.sleep(delay)
-    raise Exception("All retries failed")
-
-def process_pdf(pdf_path):
-    """Process PDF file with Gemini."""
-    try:
-        if not validate_pdf(pdf_path):
-            return pd.DataFrame()
-
-        with open(pdf_path, 'rb') as f:
-            pdf_data = base64.b64encode(f.read()).decode('utf-8')
-
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = """
+# Number of files sent to Gemini at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# Largest file sent inline with the request; Gemini caps a request at 20 MB and inline
+# bytes are base64-encoded on the wire, so anything bigger goes through the File API
+INLINE_DATA_LIMIT = 14 * 1024 * 1024
+
+# Fields the model returns as numbers; padded with 0 rather than ''
+NUMERIC_KEYS = frozenset({'Qty', 'U.Price', 'Total'})
+
+# Multiplier applied to the unit price for Marked_Up_Price (25% markup)
+MARKUP = 1.25
+
+# Supported file extensions (compared lower-cased)
+PDF_EXTS = frozenset({'.pdf'})
+IMAGE_MIME_TYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.heic': 'image/heic',
+}
+IMG_EXTS = frozenset(IMAGE_MIME_TYPES)
+SUPPORTED_EXTS = PDF_EXTS | IMG_EXTS
+
+# Extraction prompt shared by PDFs and images, sent as the model's system instruction so each request carries only the invoice
+PROMPT = """
         You are a specialized invoice data extraction system. Extract the following information from this invoice document:
 
         EXTRACTION GUIDELINES:
@@ -147,7 +81,7 @@ def process_pdf(pdf_path):
         - Be especially careful with product prefixes like "BD2", "BIA" - include them every time
         - When the same product appears in different invoices, extract it consistently
 
-        Your output should be formatted as a JSON object with the following structure:
+        Your output MUST be formatted as a JSON object with the following structure:
         {
           "Date": ["2023-06-24", "2023-06-24", ...],
           "Product": ["BD2 Coriander Eng", "BIA MINT Eng", ...],
@@ -157,181 +91,391 @@ def process_pdf(pdf_path):
         }
         """
 
-        response = call_gemini_with_retries(model, [prompt, {"mime_type": "application/pdf", "data": pdf_data}])
-
-        # Extract and process JSON
-        json_data = extract_json_from_response(response)
-        if not json_data:
-            print(f"No valid JSON found in response for {pdf_path}")
-            return pd.DataFrame()
+# Build the model once instead of on every call
+MODEL_NAME = 'gemini-2.0-flash'
+MODEL = genai.GenerativeModel(MODEL_NAME, system_instruction=PROMPT)
 
-        # Normalize and create DataFrame
-        json_data = ensure_equal_length_arrays(json_data)
-        df = pd.DataFrame(json_data)
+# Mixed into every cache key so a new model or prompt never reuses old answers
+CACHE_KEY_PREFIX = hashlib.sha256(f"{MODEL_NAME}\n{PROMPT}".encode()).digest()
 
-        # Convert numeric columns
-        for col in ['Qty', 'U.Price', 'Total']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
+def validate_pdf(pdf_path, data):
+    """Validate a PDF's bytes using PyPDF2, parsing them from memory so the file is read only once."""
+    try:
+        reader = PdfReader(BytesIO(data))
+        print(f"PDF {pdf_path} has {len(reader.pages)} pages")
+        return True
+    except Exception as e:
+        print(f"Invalid PDF {pdf_path}: {e}")
+        return False
 
-        # Calculate markup on unit price (not total)
-        if 'U.Price' in df.columns:
-            df['Marked_Up_Price'] = df['U.Price'] * 1.25
+def cache_key(data):
+    """Return the cache key for a file's bytes under the current model and prompt."""
+    sha = hashlib.sha256(CACHE_KEY_PREFIX)
+    sha.update(data)
+    return sha.hexdigest()
 
-        # Add source information and clean the data
-        df['Source'] = os.path.basename(pdf_path)
-        df = clean_dataframe(df)
+def find_json_span(text):
+    """Return the first balanced {...} block in text, or None if there isn't one."""
+    start = text.find('{')
+    if start == -1:
+        return None
 
-        return df
+    # Single pass tracking brace depth, ignoring braces inside strings
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == '{':
+            depth += 1
+        elif ch == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
 
-    except Exception as e:
-        print(f"Error processing {pdf_path}: {e}")
-        return pd.DataFrame()
+def extract_json_from_response(response_text):
+    """Extract valid JSON from the response text."""
+    json_text = find_json_span(response_text)
+    if not json_text:
+        return None
 
-def process_image(image_path):
-    """Process image file with Gemini."""
     try:
-        image = Image.open(image_path)
+        json_data = orjson.loads(json_text)
+        # Verify we have at least product data
+        if 'Product' not in json_data or not json_data['Product']:
+            return None
+        return json_data
+    except orjson.JSONDecodeError:
+        return None
 
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        prompt = """
-        You are a specialized invoice data extraction system. Extract the following information from this invoice document:
+def ensure_equal_length_arrays(json_data):
+    """Ensure all arrays in the JSON have equal length, with smarter padding."""
+    array_keys = [key for key, value in json_data.items() if isinstance(value, list)]
+    if not array_keys:
+        return json_data
 
-    EXTRACTION GUIDELINES:
-
-    1. INVOICE DATE
-       - Format: YYYY-MM-DD
-       - Location: Usually at the top of the invoice
-       - Extract only the actual invoice date, not order or shipping dates
-       - If multiple dates appear, prioritize the one labeled "Invoice Date" or "Date"
-
-    2. PRODUCT INFORMATION
-       - Extract each product as a separate line item
-       - Capture the COMPLETE product name exactly as written, including:
-         * ALL prefixes (like "BD2", "BIA", etc.)
-         * ALL details (weight, size, origin country, etc.)
-         * Maintain original capitalization and punctuation
-       - Examples: "BD2 Coriander Eng" (not just "Coriander Eng"), "Kenya Long Ravaiya -- 4kg"
-
-    3. QUANTITY
-       - Extract the exact quantity for each product
-       - Format as a number without units
-       - If quantity is not explicitly stated, leave it blank/null (do NOT default to 1)
-
-    4. UNIT PRICE
-       - Extract the price per individual unit
-       - Format as a decimal number without currency symbols
-       - Example: 10.50 (not £10.50 or $10.50)
-
-    5. TOTAL PRICE
-       - Extract the total price for each line item
-       - Format as a decimal number without currency symbols
-
-    IMPORTANT NOTES:
-    - Extract ONLY product line items (ignore subtotals, tax lines, shipping fees, etc.)
-    - Preserve exact text as it appears (don't "fix" typos or standardize names)
-    - Be especially careful with product prefixes like "BD2", "BIA" - include them every time
-    - When the same product appears in different invoices, extract it consistently
-
-    Your output MUST be formatted as a JSON object with the following structure:
-    {
-      "Date": ["2023-06-24", "2023-06-24", ...],
-      "Product": ["BD2 Coriander Eng", "BIA MINT Eng", ...],
-      "Qty": [50, 10, ...],
-      "U.Price": [7.5, 7.0, ...],
-      "Total": [375, 70, ...]
-    }
-        """
+    # Find non-empty arrays and their lengths
+    non_empty_lengths = [len(json_data[key]) for key in array_keys if json_data[key]]
+    if not non_empty_lengths:
+        return json_data
+
+    # Use the most common non-zero length (ties go to the first seen, so real rows aren't truncated)
+    target_length = mode(non_empty_lengths)
+
+    # Adjust arrays to the target length: truncate longer ones, pad shorter (or empty) ones
+    for key in array_keys:
+        values = json_data[key]
+        if len(values) > target_length:
+            json_data[key] = values[:target_length]
+        else:
+            filler = 0 if key in NUMERIC_KEYS else ''
+            json_data[key] = values + [filler] * (target_length - len(values))
+
+    return json_data
+
+def clean_dataframe(df):
+    """Remove empty or mostly zero rows from the extracted data."""
+    # Keep rows where Product has a value or Total is greater than 0,
+    # evaluated on the underlying arrays rather than chained Series ops
+    products = df['Product'].fillna('').astype(str).to_numpy(dtype=str)
+    has_product = np.char.str_len(np.char.strip(products)) > 0
+    mask = has_product
+    if 'Total' in df.columns:
+        # Total is already float64, so this is a view; NaN compares False, so no separate notna pass
+        total = df['Total'].to_numpy(dtype=np.float64)
+        np.logical_or(has_product, np.greater(total, 0), out=mask)
+
+    # Boolean indexing already returns a new frame, so no extra copy is needed
+    return df.loc[mask].reset_index(drop=True)
+
+async def call_gemini_with_retries(model, payload, retries=3, delay=5):
+    """Retry API calls on failure."""
+    for attempt in range(retries):
+        try:
+            response = await model.generate_content_async(payload)
+            return response.text
+        except Exception as e:
+            print(f"Attempt {attempt+1} failed: {e}")
+            if attempt < retries - 1:  # Don't sleep after the last attempt
+                await asyncio.sleep(delay)
+    raise Exception("All retries failed")
+
+def build_payload(data, mime_type):
+    """Build the request contents for a file sent inline; the prompt travels as the model's system instruction."""
+    return [{"mime_type": mime_type, "data": data}]
+
+async def generate_from_bytes(data, mime_type, file_path):
+    """Send one file's raw bytes to Gemini and return the response text.
+
+    Files up to INLINE_DATA_LIMIT go inline with the request; larger ones are
+    uploaded once with the File API so retries don't resend the bytes.
+    """
+    if len(data) <= INLINE_DATA_LIMIT:
+        return await call_gemini_with_retries(MODEL, build_payload(data, mime_type))
+
+    # Uploading blocks, so run it on a worker thread to keep other requests moving
+    loop = asyncio.get_running_loop()
+    uploaded = await loop.run_in_executor(
+        None, functools.partial(genai.upload_file, BytesIO(data), mime_type=mime_type,
+                                display_name=os.path.basename(file_path))
+    )
+
+    try:
+        return await call_gemini_with_retries(MODEL, [uploaded])
+    finally:
+        # Uploaded files otherwise linger for 48 hours, so remove them as soon as we're done
+        try:
+            await loop.run_in_executor(None, genai.delete_file, uploaded.name)
+        except Exception as e:
+            print(f"Could not delete uploaded file for {file_path}: {e}")
+
+async def extract_invoice_json(data, mime_type, file_path, cache_dir=None):
+    """Get one file's normalized invoice JSON from Gemini (or None).
+
+    With a cache_dir, results are stored as <sha256 of model, prompt and bytes>.json
+    and reused on later runs, so unchanged files are never sent (or parsed) again.
+    """
+    # Hashing, PDF parsing and cache file I/O block, so run them on worker threads
+    loop = asyncio.get_running_loop()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, f"{await loop.run_in_executor(None, cache_key, data)}.json")
+        if os.path.exists(cache_path):
+            print(f"Using cached result for {file_path}")
+            return orjson.loads(await loop.run_in_executor(None, Path(cache_path).read_bytes))
+
+    # Only PDFs that actually have to be sent are parsed
+    if mime_type == 'application/pdf' and not await loop.run_in_executor(None, validate_pdf, file_path, data):
+        return None
 
-        response = call_gemini_with_retries(model, [prompt, image])
+    response = await generate_from_bytes(data, mime_type, file_path)
 
-        # Extract and process JSON
-        json_data = extract_json_from_response(response)
-        if not json_data:
-            print(f"No valid JSON found in response for {image_path}")
-            return pd.DataFrame()
+    # Extract and normalize JSON
+    json_data = extract_json_from_response(response)
+    if not json_data:
+        print(f"No valid JSON found in response for {file_path}")
+        return None
+    json_data = ensure_equal_length_arrays(json_data)
 
-        # Normalize and create DataFrame
-        json_data = ensure_equal_length_arrays(json_data)
-        df = pd.DataFrame(json_data)
+    # Only cache successful extractions so failed files are retried on the next run
+    if cache_path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first so an interrupted run never leaves a partial cache entry
+            tmp_path = f"{cache_path}.tmp"
+            await loop.run_in_executor(None, Path(tmp_path).write_bytes, orjson.dumps(json_data))
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f"Could not cache result for {file_path}: {e}")
+    return json_data
 
-        # Convert numeric columns
-        for col in ['Qty', 'U.Price', 'Total']:
-            if col in df.columns:
-                df[col] = pd.to_numeric(df[col], errors='coerce')
+async def process_pdf(pdf_path, cache_dir=None):
+    """Process PDF file with Gemini, returning its normalized JSON (or None)."""
+    try:
+        # Reading the file blocks, so run it on a worker thread to keep other requests moving
+        loop = asyncio.get_running_loop()
+        pdf_data = await loop.run_in_executor(None, Path(pdf_path).read_bytes)
 
-        # Calculate markup on unit price (not total)
-        if 'U.Price' in df.columns:
-            df['Marked_Up_Price'] = df['U.Price'] * 1.25
+        return await extract_invoice_json(pdf_data, 'application/pdf', pdf_path, cache_dir)
 
-        # Add source information and clean the data
-        df['Source'] = os.path.basename(image_path)
-        df = clean_dataframe(df)
+    except Exception as e:
+        print(f"Error processing {pdf_path}: {e}")
+        return None
+
+async def process_image(image_path, cache_dir=None):
+    """Process image file with Gemini, returning its normalized JSON (or None)."""
+    try:
+        # Send the file's own bytes rather than a decoded PIL image, which the SDK would re-encode;
+        # reading them blocks, so run it on a worker thread as process_pdf does
+        loop = asyncio.get_running_loop()
+        image_data = await loop.run_in_executor(None, Path(image_path).read_bytes)
+        mime_type = IMAGE_MIME_TYPES[Path(image_path).suffix.lower()]
 
-        return df
+        return await extract_invoice_json(image_data, mime_type, image_path, cache_dir)
 
     except Exception as e:
         print(f"Error processing {image_path}: {e}")
-        return pd.DataFrame()
+        return None
 
-def process_folder(input_folder="/content/invoices", output_folder="output"):
-    """Process all invoices in folder and save results."""
-    os.makedirs(output_folder, exist_ok=True)
-    all_data = []
-
-    # Get list of files to process
-    files = os.listdir(input_folder)
-    total_files = len(files)
-    print(f"Found {total_files} files in {input_folder}")
-
-    # Process files
-    processed_count = 0
-    for file in files:
-        file_path = os.path.join(input_folder, file)
-        if os.path.isdir(file_path):
+def to_float_array(values):
+    """Convert a list of JSON values to a float array, coercing unparseable entries to NaN."""
+    try:
+        # Fast path: JSON numbers (and None) cast directly in C; nested lists fall through
+        array = np.asarray(values, dtype=np.float64)
+        if array.ndim == 1:
+            return array
+    except (TypeError, ValueError):
+        pass
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float64)
+
+def build_dataframe(results):
+    """Build one cleaned, marked-up DataFrame from every file's JSON.
+
+    results is a list of (source, json_data) pairs. Each file's columns are
+    normalized on their own (numeric ones cast to float64 arrays), so a
+    malformed response only drops that file; the columns are then
+    concatenated so pandas constructs each one only once.
+
+    Returns the DataFrame and, per source, the columns that file's own
+    output should have.
+    """
+    files = []
+    for source, json_data in results:
+        try:
+            # Row count for this file; scalar values are repeated across its rows
+            n = next((len(v) for v in json_data.values() if isinstance(v, list)), 0)
+            if n == 0:
+                continue
+
+            # Convert numeric columns straight to float arrays so pandas needn't infer their types
+            file_columns = {}
+            for key, values in json_data.items():
+                if not isinstance(values, list):
+                    values = [values] * n
+                file_columns[key] = to_float_array(values) if key in NUMERIC_KEYS else values
+        except Exception as e:
+            print(f"Error processing {source}: {e}")
             continue
+        files.append((source, n, file_columns))
+
+    if not files:
+        return pd.DataFrame(), {}
+
+    # Concatenate each column across files, filling in columns a file didn't have
+    keys = dict.fromkeys(key for _, _, file_columns in files for key in file_columns)
+    columns = {}
+    for key in keys:
+        if key in NUMERIC_KEYS:
+            columns[key] = np.concatenate([file_columns.get(key, np.full(n, np.nan))
+                                           for _, n, file_columns in files])
+        else:
+            columns[key] = [value for _, n, file_columns in files
+                            for value in file_columns.get(key, [None] * n)]
+
+    # Calculate markup on unit price (not total) on the array, before the frame exists
+    if 'U.Price' in columns:
+        columns['Marked_Up_Price'] = columns['U.Price'] * MARKUP
 
-        processed_count += 1
-        print(f"Processing file {processed_count}/{total_files}: {file}")
+    # Add source information and clean the data
+    columns['Source'] = [source for source, n, _ in files for _ in range(n)]
 
-        if file.lower().endswith(('.pdf', '.PDF')):
-            df = process_pdf(file_path)
-        elif file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.heic')):
-            df = process_image(file_path)
+    # Each file's own columns, as if its DataFrame had been built on its own
+    columns_by_source = {
+        source: [*file_columns, *(['Marked_Up_Price'] if 'U.Price' in file_columns else []), 'Source']
+        for source, _, file_columns in files
+    }
+    return clean_dataframe(pd.DataFrame(columns, copy=False)), columns_by_source
+
+def write_excel(df, output_path):
+    """Write a DataFrame to Excel with the xlsxwriter engine.
+
+    constant_memory is deliberately not used: pandas writes cells column by column,
+    and that mode silently drops any cell written to a row it has already flushed.
+    """
+    with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False)
+
+async def _process(file_path, sem, cache_dir=None):
+    """Process a single invoice file, holding a semaphore slot while in flight."""
+    file = os.path.basename(file_path)
+    async with sem:
+        print(f"Processing file: {file}")
+        if Path(file).suffix.lower() in PDF_EXTS:
+            json_data = await process_pdf(file_path, cache_dir)
         else:
-            print(f"Skipping unsupported file: {file}")
-            continue
+            json_data = await process_image(file_path, cache_dir)
 
-        if not df.empty:
-            # Save individual file
-            output_path = os.path.join(output_folder, f"{Path(file).stem}.xlsx")
-            df.to_excel(output_path, index=False)
-            print(f"Saved data to {output_path}")
-            all_data.append(df)
+    if not json_data:
+        print(f"No data extracted from {file}")
+    return file, json_data
+
+async def process_folder_async(input_folder="/content/invoices", output_folder="output",
+                               max_concurrency=MAX_CONCURRENT_REQUESTS, use_cache=True):
+    """Process all invoices in folder and save results.
+
+    Await this directly where an event loop is already running (Jupyter/Colab);
+    otherwise call process_folder. Extraction results are cached in
+    <output_folder>/.cache unless use_cache is False.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Get list of files to process (scandir entries carry their file type, so no extra stat per file)
+    with os.scandir(input_folder) as it:
+        entries = [entry for entry in it if entry.is_file()]
+    print(f"Found {len(entries)} files in {input_folder}")
+
+    # Collect supported files
+    file_paths = []
+    for entry in entries:
+        if Path(entry.name).suffix.lower() in SUPPORTED_EXTS:
+            file_paths.append(entry.path)
         else:
-            print(f"No data extracted from {file}")
+            print(f"Skipping unsupported file: {entry.name}")
 
-    # Save combined results
-    if all_data:
-        # Combine all individual DataFrames
-        combined_df = pd.concat(all_data, ignore_index=True)
+    # Process files concurrently on one event loop, with at most max_concurrency requests in flight
+    print(f"Processing {len(file_paths)} files with up to {max_concurrency} concurrent requests")
+    sem = asyncio.Semaphore(max_concurrency)
+    cache_dir = os.path.join(output_folder, ".cache") if use_cache else None
+    tasks = [asyncio.create_task(_process(file_path, sem, cache_dir)) for file_path in file_paths]
+    results = [(file, json_data) for file, json_data in await asyncio.gather(*tasks) if json_data]
 
-        # Apply final cleaning to remove any remaining empty/zero rows
-        combined_df = clean_dataframe(combined_df)
+    # Build every file's rows in one DataFrame
+    combined_df, columns_by_source = build_dataframe(results)
 
-        # Sort by Date and then by Product for better organization
+    # Save combined results
+    if not combined_df.empty:
+        # Save individual files on worker threads so they are written while the combined file is,
+        # each with only the columns its own invoice had
+        loop = asyncio.get_running_loop()
+        output_paths = []
+        writes = []
+        for source, file_df in combined_df.groupby('Source', sort=False):
+            output_path = os.path.join(output_folder, f"{Path(source).stem}.xlsx")
+            output_paths.append(output_path)
+            writes.append(loop.run_in_executor(None, write_excel, file_df[columns_by_source[source]], output_path))
+
+        # Sort by Date and then by Product for better organization (clean_dataframe already reset the index)
         if 'Date' in combined_df.columns:
-            combined_df.sort_values(['Date', 'Product'], inplace=True)
-        combined_df.reset_index(drop=True, inplace=True)
+            combined_df.sort_values(['Date', 'Product'], inplace=True, ignore_index=True)
 
         # Generate timestamp and save
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         combined_path = os.path.join(output_folder, f"combined_invoices_{timestamp}.xlsx")
-        combined_df.to_excel(combined_path, index=False)
-        print(f"\nProcessed {len(all_data)} files successfully. Combined file saved to {combined_path}")
+        write_excel(combined_df, combined_path)
+
+        await asyncio.gather(*writes)
+        for output_path in output_paths:
+            print(f"Saved data to {output_path}")
+        print(f"\nProcessed {len(output_paths)} files successfully. Combined file saved to {combined_path}")
         print(f"Combined file contains {len(combined_df)} rows of data after cleaning.")
     else:
         print("No data extracted from any files. Combined file not created.")
 
+def process_folder(input_folder="/content/invoices", output_folder="output",
+                   max_concurrency=MAX_CONCURRENT_REQUESTS, use_cache=True):
+    """Process all invoices in folder and save results (see process_folder_async)."""
+    coro = process_folder_async(input_folder, output_folder, max_concurrency, use_cache)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        # No loop running (plain script): start one here
+        asyncio.run(coro)
+        return
+
+    # A loop is already running (Jupyter/Colab), and asyncio.run can't nest inside it,
+    # so run the pipeline on its own loop in a worker thread and wait for it
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(asyncio.run, coro).result()
+
 if __name__ == "__main__":
     process_folder()